@@ -2,7 +2,7 @@
 Generates an HTML schedule for CSSE 120 from the list of
 learning objectives and relevant information about the term dates.
 
-Requires (via pip):  gfm bs4
+Requires (via pip):  cmarkgfm bs4 lxml  (or mistune instead of cmarkgfm)
 
 Author: David Mutchler and his colleagues.
 """
@@ -11,9 +11,9 @@ import datetime
 import string
 import re
 import abc
-import bs4  # BeautifulSoup
-import markdown  # Github Flavored Markdown
 import enum
+import functools
+import concurrent.futures
 
 def main():
     """ Make a schedule for the indicated term. """
@@ -21,8 +21,8 @@ def main():
     html = maker.make_schedule()
 
 
-COMMENT_BEGIN_INDICATOR = r'^!!! BEGIN COMMENT'
-COMMEND_END_INDICATOR = r'^!!! END COMMENT'
+COMMENT_BEGIN_INDICATOR = '!!! BEGIN COMMENT'  # At the start of a line
+COMMEND_END_INDICATOR = '!!! END COMMENT'  # At the start of a line
 COMMENT_INDICATOR = "!!!"
 SESSION_INDICATOR = r'^.*Session[ ]*[0-9]*:'
 EXAM_INDICATOR = r'Exam '
@@ -45,6 +45,12 @@ EVENING_EXAM_TEMPLATE = string.Template("""
 
 SHOW_TOPICS = False
 
+# Whether to make the HTML for the sessions in separate processes.
+# Worthwhile only if making a session's HTML is expensive, since
+# starting the processes and pickling the sessions costs far more
+# than rendering 30 titles.
+RENDER_IN_PARALLEL = False
+
 
 @enum.unique
 class SessionType(enum.Enum):
@@ -60,6 +66,99 @@ class SessionType(enum.Enum):
 RE_MULTILINE = re.MULTILINE  # @UndefinedVariable
 RE_DOTALL = re.DOTALL  # @UndefinedVariable
 
+# Compiled once, here, rather than looked up in re's cache on every use.
+_SESSION_RE = re.compile(SESSION_INDICATOR, RE_MULTILINE)
+_TEST_RE = re.compile(r'.*Test [0-9]\..*', RE_DOTALL)
+_SPRINT_RE = re.compile(r'.*Sprint [0-9].*', RE_DOTALL)
+_TEST_SUB_RE = re.compile(r'(Test [0-9]\.)')
+# Lines that markdown might treat as other than plain paragraph text:
+# indented, list, blockquote, heading underline, or fence markers.
+_BLOCK_MARKDOWN_RE = re.compile(r'^(?:\s|[-+*>=~]|\d+[.)])', RE_MULTILINE)
+# A tag, or an entire <pre> or <textarea> element (whose content is kept).
+_TAG_RE = re.compile(r'(<(?:pre|textarea)\b.*?</(?:pre|textarea)>|<[^>]*>)',
+                     RE_DOTALL | re.IGNORECASE)
+_TAG_NAME_RE = re.compile(r'<([a-zA-Z0-9]+)')
+
+# Parenthetical expressions are additional markup, except that doubled
+# parentheses stand for literal ones.  A period right after the closing
+# parenthesis goes inside the span.
+_PAREN_RE = re.compile(r'\(\(|\)\)|\)\.|\(|\)')
+_PAREN_REPLACEMENTS = {'((': '(',
+                       '))': ')',
+                       ').': ').</span>',
+                       '(': '<span class=parenthetical>(',
+                       ')': ')</span>'}
+
+
+# Elements that never have content (hence no closing tag).
+VOID_ELEMENTS = frozenset(['area', 'base', 'br', 'col', 'embed', 'hr',
+                           'img', 'input', 'link', 'meta', 'param',
+                           'source', 'track', 'wbr'])
+
+# Elements whose content must be output exactly as is.
+VERBATIM_ELEMENTS = frozenset(['pre', 'textarea'])
+
+
+def indent_html(html, indent='  '):
+    """
+    Returns the given well-formed HTML with each tag and each piece of
+    (stripped) text on its own line, indented according to its depth.
+    Like BeautifulSoup's  prettify,  but without parsing the HTML.
+    The content of  <pre>  and  <textarea>  elements is left unchanged.
+    """
+    lines = []
+    depth = 0
+    for token in _TAG_RE.split(html):
+        token = token.strip()
+        if not token:
+            continue
+        if token.startswith('</'):
+            depth = depth - 1
+            lines.append(indent * depth + token)
+        else:
+            lines.append(indent * depth + token)
+            if not token.endswith('/>'):
+                match = _TAG_NAME_RE.match(token)
+                if match:
+                    name = match.group(1).lower()
+                    if (name not in VOID_ELEMENTS
+                            and name not in VERBATIM_ELEMENTS):
+                        depth = depth + 1
+
+    return '\n'.join(lines) + '\n'
+
+
+# The markdown and HTML libraries are large, so they are imported
+# only when first needed (and only once).
+@functools.lru_cache(maxsize=None)
+def _bs4():
+    import bs4  # BeautifulSoup
+    return bs4
+
+
+@functools.lru_cache(maxsize=None)
+def _gfm_converter():
+    """ Returns a function that converts GFM to HTML. """
+    try:
+        import cmarkgfm  # Github Flavored Markdown
+    except ImportError:
+        import mistune  # Slower, pure-Python fallback
+        # Build the parser (and its plugins) once, then reuse it.
+        return mistune.create_markdown(escape=False)
+
+    options = cmarkgfm.Options.CMARK_OPT_UNSAFE
+    return functools.partial(cmarkgfm.github_flavored_markdown_to_html,
+                             options=options)
+
+
+def gfm_to_html(gfm):
+    """
+    Returns the HTML for the given string of Github Flavored Markdown.
+    Raw HTML in the markdown (e.g. <br>) is passed through unchanged.
+    Like Python-Markdown's, the result has no trailing newline.
+    """
+    return _gfm_converter()(gfm).rstrip('\n')
+
 
 class TermInfo(object):
     """
@@ -85,6 +184,12 @@ class TermInfo(object):
         exam2_msg = exam1_msg
         self.evening_exams = [ScheduleDate(2017, 9, 14, exam1_msg),
                               ScheduleDate(2017, 10, 5, exam2_msg)]
+
+        # The above, keyed by their datetime.date, for fast lookup:
+        self.skip_by_date = {schedule_date.datetime_date: schedule_date
+                             for schedule_date in self.dates_to_skip}
+        self.exams_by_date = {schedule_date.datetime_date: schedule_date
+                              for schedule_date in self.evening_exams}
         self.start_session_number = 1
 
         csse120_folder = "/Users/david/classes/120/"
@@ -102,20 +207,23 @@ class TermInfo(object):
 
 
 class ScheduleDate(object):
-    def __init__(self, year, day, month, message=None):
-        self.datetime_date = datetime.date(year, day, month)
+    __slots__ = ('datetime_date', 'message')
+
+    def __init__(self, year, month, day, message=None):
+        self.datetime_date = datetime.date(year, month, day)
         self.message = message
 
     def __repr__(self):
         return '{} {}'.format(self.datetime_date, self.message)
 
-    def __eq__(self, date):
-        # Date may be a ScheduleDate or it may be a datetime.date.
-        try:
-            return (self.datetime_date == date.datetime_date
-                    and self.message == date.message)
-        except AttributeError:
-            return self.datetime_date == date
+    def __eq__(self, other):
+        if not isinstance(other, ScheduleDate):
+            return NotImplemented
+        return (self.datetime_date == other.datetime_date
+                and self.message == other.message)
+
+    def __hash__(self):
+        return hash(self.datetime_date)
 
 
 class ScheduleMaker(object):
@@ -147,8 +255,13 @@ class ScheduleMaker(object):
         self.add_dates_numbers_and_NoClassSessions()
 
         # Make the HTML for each session:
-        for session in self.sessions:
-            session.make_html()
+        if RENDER_IN_PARALLEL:
+            with concurrent.futures.ProcessPoolExecutor() as executor:
+                self.sessions = list(executor.map(_render_session,
+                                                  self.sessions))
+        else:
+            for session in self.sessions:
+                session.make_html()
 
         # Make and prettify the entire table of sessions.
         self.make_html_table()
@@ -171,8 +284,7 @@ class ScheduleMaker(object):
         data = self.strip_comments()
 
         # Split the data by sessions:
-        self.topics_by_session = re.split(SESSION_INDICATOR, data,
-                                          flags=RE_MULTILINE)
+        self.topics_by_session = _SESSION_RE.split(data)
         self.topics_by_session = self.topics_by_session[1:]  # Ignore 1st item
 
         # Confirm that the number of topics matches the number of sessions.
@@ -206,10 +318,10 @@ class ScheduleMaker(object):
         lines_to_keep = []
         for line in lines:
             if i_am_inside_a_comment:
-                if re.match(COMMEND_END_INDICATOR, line):
+                if line.startswith(COMMEND_END_INDICATOR):
                     i_am_inside_a_comment = False
             else:
-                if COMMENT_BEGIN_INDICATOR in line:
+                if line.startswith(COMMENT_BEGIN_INDICATOR):
                     i_am_inside_a_comment = True
                 elif COMMENT_INDICATOR not in line:
                     lines_to_keep.append(line)
@@ -217,42 +329,38 @@ class ScheduleMaker(object):
         return '\n'.join(lines_to_keep)
 
     def add_dates_numbers_and_NoClassSessions(self):
-        date = self.term_info.start_date
+        # The dates from the start of term to end of term (inclusive)
+        # that are on class days-of-week.
+        start_date = self.term_info.start_date
+        days_in_term = (self.term_info.end_date - start_date).days + 1
+        days_of_week = frozenset(self.term_info.days_of_week)
+        all_dates = (start_date + datetime.timedelta(k)
+                     for k in range(days_in_term))
+        class_dates = [date for date in all_dates
+                       if date.isoweekday() in days_of_week]
 
         session_number = self.term_info.start_session_number
         session_index = 0
-        while True:
-            # Go through each date from the start of term to end of term.
-
-            # Done when we get to the last date of the term.
-            if date > self.term_info.end_date:
-                break
-
-            # Deal only with dates that are on class days-of-week.
-            if date.isoweekday() in self.term_info.days_of_week:
-                if date in self.term_info.dates_to_skip:
-                    # Make a NoClassSession
-                    index = self.term_info.dates_to_skip.index(date)
-                    schedule_date = self.term_info.dates_to_skip[index]
-
-                    session = NoClassSession(schedule_date)
-                    self.sessions.insert(session_index, session)
-                else:
-                    # Add date and session number to this session.
-                    session = self.sessions[session_index]
-                    session.datetime_date = date
-
-                    session.session_number = session_number
-                    session_number = session_number + 1
-
-                    if date in self.term_info.evening_exams:
-                        evening_exams = self.term_info.evening_exams
-                        session.session_type = SessionType.EVENING_EXAM
-                        index = evening_exams.index(date)
-                        session.message = evening_exams[index].message
-
-                session_index = session_index + 1
-            date = date + datetime.timedelta(1)
+        for date in class_dates:
+            schedule_date = self.term_info.skip_by_date.get(date)
+            if schedule_date:
+                # Make a NoClassSession
+                session = NoClassSession(schedule_date)
+                self.sessions.insert(session_index, session)
+            else:
+                # Add date and session number to this session.
+                session = self.sessions[session_index]
+                session.datetime_date = date
+
+                session.session_number = session_number
+                session_number = session_number + 1
+
+                exam = self.term_info.exams_by_date.get(date)
+                if exam:
+                    session.session_type = SessionType.EVENING_EXAM
+                    session.message = exam.message
+
+            session_index = session_index + 1
 
     def make_html_table(self):
         """
@@ -260,25 +368,28 @@ class ScheduleMaker(object):
         based on the (previously computed) HTML for the self.sessions
         """
         days_in_week = len(self.term_info.days_of_week)
-        sessions_html = ''
+        parts = []
         for k in range(len(self.sessions)):
             if k % days_in_week == 0:
-                sessions_html += ScheduleTable.ROW_START
+                parts.append(ScheduleTable.ROW_START)
 
-            sessions_html += (ScheduleTable.ITEM_START
-                              + self.sessions[k].html
-                              + ScheduleTable.ITEM_END)
+            parts.append(ScheduleTable.ITEM_START)
+            parts.append(self.sessions[k].html)
+            parts.append(ScheduleTable.ITEM_END)
 
             if k % days_in_week == days_in_week - 1:
-                sessions_html += ScheduleTable.ROW_END
+                parts.append(ScheduleTable.ROW_END)
+        sessions_html = ''.join(parts)
 
         self.html = (ScheduleHeader(self.term_info.weekdays_of_week).html
                      + sessions_html
                      + ScheduleTrailer().html)
 
     def write_html(self, html):
-        with open(self.term_info.schedule_table_filename, 'w') as file:
-            file.write(html)
+        # Encode once (as UTF-8, per the page's <meta charset>)
+        # and write the bytes in a single call.
+        with open(self.term_info.schedule_table_filename, 'wb') as file:
+            file.write(html.encode('utf-8'))
 
 #     def add_topics_and_html_to_sessions(self, topics_by_session, sessions):
 #         k = 0
@@ -290,71 +401,77 @@ class ScheduleMaker(object):
 #             k = k + 1
 
     def make_html_from_topics(self, topics_for_session):
-        # Make the session title become a top-level list item,
-        # and increase the indentation of all subsequent lines.
-        topics_for_session = topics_for_session.replace('\n',
-                                                        '\n    ')
-        topics_for_session = '+ ' + topics_for_session
-#         print(topics_for_session)
+        return make_html_from_topics(topics_for_session)
 
 
-        # Convert each topic to HTML using Github Flavored Markdown.
-        html = markdown.markdown(topics_for_session)
-#         print(html)
-
-        # Add class info to the HTML for topics, tests, and sprints.
-        # The following is brittle.
-        ul_class = 'topics collapsibleList'
-        li_class = 'topic'
-        if re.match(r'.*Test [0-9]\..*', html, RE_DOTALL):
-            ul_class += ' exam'
-            li_class += ' exam'
-        elif re.match(r'.*Sprint [0-9].*', html, RE_DOTALL):
-            ul_class += ' sprint'
-            li_class += ' sprint'
-
-        # CONSIDER: the following adds the class to the FIRST <ul>
-        # but to ALL <li>'s.  Is that what we want for sub-lists?
-        html = html.replace('<ul>',
-                            '<ul class="' + ul_class + '">',
-                            1)
-        html = html.replace('<li>',
-                            '<li class="' + li_class + '">')
-
-        # Add details for Tests.
-        for_tests = ExamTopic.EVENING_EXAM_TEMPLATE.substitute()
-        html = re.sub(r'(Test [0-9]\.)', r'\1' + for_tests, html)
-
-        # Parenthetical expressions are additional markup:
-        DOUBLE_OPEN_PARENTHESES = '!!!START_CANNOT_OCCUR_I_HOPE!!!'
-        DOUBLE_CLOSE_PARENTHESES = '!!!END_CANNOT_OCCUR_I_HOPE!!!'
-        html = html.replace('((', DOUBLE_OPEN_PARENTHESES)
-        html = html.replace('))', DOUBLE_CLOSE_PARENTHESES)
-        html = html.replace('(', '<span class=parenthetical>(')
-        html = html.replace(')', ')</span>')
-        html = html.replace('</span>.', '.</span>')
-        html = html.replace(DOUBLE_OPEN_PARENTHESES, '(')
-        html = html.replace(DOUBLE_CLOSE_PARENTHESES, ')')
-
-        pretty_html = bs4.BeautifulSoup(html, "html.parser").prettify()
-
-        lines = pretty_html.split('\n')
-        for k in range(len(lines)):
-            lines[k] = re.sub(r'^( *)', r'\1\1', lines[k])
-
-        final_html = '\n'.join(lines)
-        # TODO: Deal with punctuation after a tag end.
-
-        return final_html
+def make_html_from_topics(topics_for_session: str) -> str:
+    """
+    Returns the (indented) HTML for the given topics for a session,
+    written in Github Flavored Markdown.  The first line of the topics
+    becomes the top-level list item.
+    """
+    # Make the session title become a top-level list item,
+    # and increase the indentation of all subsequent lines.
+    topics_for_session = topics_for_session.replace('\n',
+                                                    '\n    ')
+    topics_for_session = '+ ' + topics_for_session
+#     print(topics_for_session)
+
+
+    # Convert each topic to HTML using Github Flavored Markdown.
+    html = gfm_to_html(topics_for_session)
+#     print(html)
+
+    # Add class info to the HTML for topics, tests, and sprints.
+    # The following is brittle.
+    ul_class = 'topics collapsibleList'
+    li_class = 'topic'
+    if _TEST_RE.match(html):
+        ul_class += ' exam'
+        li_class += ' exam'
+    elif _SPRINT_RE.match(html):
+        ul_class += ' sprint'
+        li_class += ' sprint'
+
+    # CONSIDER: the following adds the class to the FIRST <ul>
+    # but to ALL <li>'s.  Is that what we want for sub-lists?
+    html = html.replace('<ul>',
+                        '<ul class="' + ul_class + '">',
+                        1)
+    html = html.replace('<li>',
+                        '<li class="' + li_class + '">')
+
+    # Add details for Tests.
+    html = _TEST_SUB_RE.sub(r'\1' + _FOR_TESTS_HTML, html)
+
+    # Parenthetical expressions are additional markup (in one pass):
+    html = _PAREN_RE.sub(lambda match: _PAREN_REPLACEMENTS[match.group()],
+                         html)
+
+    # The HTML is well-formed, so indent it without re-parsing it.
+    final_html = indent_html(html)
+    # TODO: Deal with punctuation after a tag end.
+
+    return final_html
+
+
+def _render_session(session):
+    """ Makes the HTML for the given Session and returns the Session. """
+    # At module level so that a ProcessPoolExecutor can pickle it.
+    session.make_html()
+    return session
 
 
 def prettify(markup):
-    soup = bs4.BeautifulSoup(markup, "html5lib")
+    soup = _bs4().BeautifulSoup(markup, "lxml")
     return soup.prettify()
 
 
 class Session(abc.ABC):
     """ Data associated with a single Session. """
+    __slots__ = ('datetime_date', 'title', 'session_number', 'topics',
+                 'session_type', 'message', 'html', 'preparation_link',
+                 'topics_html')
 
     def __init__(self, datetime_date=None, title=None, session_number=None,
                  topics=None, session_type=None, message=None):
@@ -380,6 +497,8 @@ class Session(abc.ABC):
 
 
 class NoClassSession(Session):
+    __slots__ = ()
+
     NO_CLASS_TEMPLATE = string.Template("""
         <div class="no_class_title">$SessionTitle</div>
         <div class="session_date">$SessionDate</div>""")
@@ -396,6 +515,8 @@ class NoClassSession(Session):
 
 
 class ClassSession(Session):
+    __slots__ = ()
+
     SESSION_TEMPLATE = string.Template("""
         <div class=session_identifier>
           <span class="session_preparation">$SessionPreparationLink</span>
@@ -413,6 +534,10 @@ class ClassSession(Session):
     LINK_TO_PREP = ('<a href="Sessions/Session{:02}/index.html">'
                     + 'Preparation</a>')
 
+    # Titles without any of these (and with no line that starts like a
+    # block of markdown) are rendered without the markdown engine.
+    MARKDOWN_CHARACTERS = '*_`[!#<>&\\'
+
     def __init__(self, title, topics):
         session_type = self.find_session_type(topics)
         super().__init__(title=title, topics=topics, session_type=session_type)
@@ -421,9 +546,13 @@ class ClassSession(Session):
         self.preparation_link = ClassSession.LINK_TO_PREP.format(
             self.session_number)
 
-        title = markdown.markdown(self.title.replace('/', '<br>\n'))
+        title = self.title.strip().replace('/', '<br>\n')
+        if (any(c in self.title for c in ClassSession.MARKDOWN_CHARACTERS)
+                or _BLOCK_MARKDOWN_RE.search(title)):
+            title = gfm_to_html(title)
+        else:
+            title = '<p>' + title + '</p>'
 
-        print('Title:' + title)
         self.html = ClassSession.SESSION_TEMPLATE.substitute(
             SessionPreparationLink=self.preparation_link,
             SessionNumber=self.session_number,
@@ -449,7 +578,7 @@ class ClassSession(Session):
           -- Exam, Sprint, or Regular
         """
         # Start with the topics:
-        self.topics_html = gfm.markdown(self.topics)
+        self.topics_html = gfm_to_html(self.topics)
 
 
 #         topics_for_GFM = self.topics
@@ -578,9 +707,8 @@ href="http://fonts.googleapis.com/css?family=Open+Sans">
 
     def __init__(self, weekdays_of_week):
         TH_template = ScheduleHeader.TH_FOR_DAY_OF_WEEK_TEMPLATE
-        THs = ''
-        for weekday in weekdays_of_week:
-            THs += TH_template.substitute(DAY=weekday)
+        THs = ''.join(TH_template.substitute(DAY=weekday)
+                      for weekday in weekdays_of_week)
 
         t = ScheduleHeader.HEADER_TEMPLATE
 
@@ -665,6 +793,12 @@ class ExamTopic(object):
 """)
 
 
+# The details added after each Test in the topics.  They never vary,
+# so substitute them into the template just once.
+_FOR_TESTS_HTML = ExamTopic.EVENING_EXAM_TEMPLATE.substitute(
+    RegularClassDay='Thursday', ExamDay='Thursday')
+
+
 
 
 
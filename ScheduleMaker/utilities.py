@@ -59,8 +59,6 @@ def generic_repr(instance_of_class, string_of_data_attributes):
     for attribute_name in attribute_names:
         attributes.append(getattr(instance_of_class, attribute_name))
 
-    format_string = '\n{}('
-    format_string += (len(attributes) - 1) * '{!r}, \n'
-    format_string += '{!r})\n'
-
-    return format_string.format(class_name, *attributes)
+    return ('\n' + class_name + '('
+            + ', \n'.join(repr(attribute) for attribute in attributes)
+            + ')\n')